@@ -1,19 +1,60 @@
 # app.py
+import asyncio
+import json
 import re
+import types
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib3.util import Retry
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import diskcache
+except ImportError:
+    diskcache = None
+
+try:
+    import requests_cache
+except ImportError:
+    requests_cache = None
+
 import streamlit as st
 import pandas as pd
 from typing import Any, Dict, List, Optional, Tuple
 from geopy.geocoders import Nominatim
 
+def _loads(content: bytes) -> Any:
+    # orjson's SIMD decoder is 2-5x faster on nested payloads like the
+    # SoilGrids response; stdlib json is the fallback.
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+def _dumps_pretty(obj: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+    return json.dumps(obj, indent=2)
+
 SOILGRIDS_API = "https://rest.isric.org/soilgrids/v2.0/properties/query"
 PROPERTIES = ["soc", "phh2o", "sand", "silt", "clay", "bdod", "ocs"]
+PROPERTIES_UPPER = [p.upper() for p in PROPERTIES]
 PREFERRED_DEPTHS = [(0.0, 5.0), (0.0, 30.0), (0.0, 15.0)]
+# interval -> preference rank, built once; unlisted intervals sort last
+_PREFERRED_DEPTH_RANK = {d: i for i, d in enumerate(PREFERRED_DEPTHS)}
 
-_depth_label_re = re.compile(r"(\d+\.?\d*)\s*[-–]\s*(\d+\.?\d*)")
+_depth_label_re = re.compile(r"(\d+(?:\.\d+)?)\s*[-–—]\s*(\d+(?:\.\d+)?)")
 
 # Default values if SoilGrids returns null (example realistic defaults)
-DEFAULT_VALUES = {
+DEFAULT_VALUES = types.MappingProxyType({
     "soc": 15.0,      # g/kg
     "phh2o": 6.5,     # -
     "sand": 30.0,     # %
@@ -21,12 +62,21 @@ DEFAULT_VALUES = {
     "clay": 30.0,     # %
     "bdod": 1.3,      # kg/dm³
     "ocs": 4.0        # kg/m²
-}
+})
+
+def _snap(x: float) -> float:
+    # 0.002° grid (~200 m) — SoilGrids' native ~250 m cells return the
+    # same values for coordinates this close, so snapping turns float
+    # jitter into cache hits.
+    return round(x * 500) / 500
 
 def _try_parse_depth_from_label(label: str) -> Optional[Tuple[float, float]]:
     if not label or not isinstance(label, str):
         return None
-    m = _depth_label_re.search(label)
+    if not any(c.isdigit() for c in label):
+        return None
+    # Depth labels start with the number ("0-5cm"), so match beats search
+    m = _depth_label_re.match(label.strip())
     if m:
         try:
             top = float(m.group(1))
@@ -38,8 +88,13 @@ def _try_parse_depth_from_label(label: str) -> Optional[Tuple[float, float]]:
 
 def _get_top_bottom_from_range(d: Dict[str, Any]) -> Optional[Tuple[float, float]]:
     rng = d.get("range") or {}
-    top = rng.get("top") or rng.get("top_depth")
-    bottom = rng.get("bottom") or rng.get("bottom_depth")
+    # Explicit None checks: `or` would skip a legitimate top of 0
+    top = rng.get("top")
+    if top is None:
+        top = rng.get("top_depth")
+    bottom = rng.get("bottom")
+    if bottom is None:
+        bottom = rng.get("bottom_depth")
     try:
         if top is not None and bottom is not None:
             return (float(top), float(bottom))
@@ -47,50 +102,112 @@ def _get_top_bottom_from_range(d: Dict[str, Any]) -> Optional[Tuple[float, float
         return None
     return None
 
-def _extract_numeric_from_values(values: Dict[str, Any], d_factor: float = 1) -> Optional[float]:
-    if not isinstance(values, dict):
+_PREFER = ("mean", "Q0.5", "median", "Q0.05", "Q0.95")
+
+def _extract_numeric_from_values(values: Dict[str, Any], inv: float = 1.0) -> Optional[float]:
+    if not values:
         return None
-    prefer = ["mean", "Q0.5", "median", "Q0.05", "Q0.95"]
-    for k in prefer:
+    # "mean" is present on typical SoilGrids responses, so this usually
+    # returns on the first probe
+    for k in _PREFER:
         v = values.get(k)
         if v is not None:
             try:
-                return float(v) / d_factor
-            except Exception:
-                continue
-    for k, v in values.items():
+                return float(v) * inv
+            except (TypeError, ValueError):
+                pass
+    for v in values.values():
         if v is None:
             continue
         try:
-            return float(v) / d_factor
-        except Exception:
+            return float(v) * inv
+        except (TypeError, ValueError):
             continue
     return None
 
 def _extract_unit(layer: Dict[str, Any]) -> Optional[str]:
     um = layer.get("unit_measure") or {}
-    unit = um.get("target_units") or um.get("mapped_units") or um.get("unit")
-    return unit
+    for key in ("target_units", "mapped_units", "unit"):
+        unit = um.get(key)
+        if unit is not None:
+            return unit
+    return None
+
+@st.cache_resource
+def _session() -> requests.Session:
+    # Keep-alive session with pooling and retries, shared across reruns.
+    # With requests-cache installed, 200 responses are also persisted to
+    # SQLite so the HTTP layer itself survives restarts — SoilGrids data
+    # is effectively static, hence the month-long expiry.
+    if requests_cache is not None:
+        s = requests_cache.CachedSession(
+            "/tmp/soilgrids_http",
+            backend="sqlite",
+            expire_after=30 * 86400,
+            allowable_codes=(200,),
+            allowable_methods=("GET",),
+            stale_if_error=True,
+            # Honor ETag/Cache-Control: expired entries revalidate with
+            # If-None-Match, and a 304 reuses the stored body
+            cache_control=True,
+        )
+    else:
+        s = requests.Session()
+    s.headers["Accept"] = "application/json"
+    # The JSON payload compresses ~5x; requests decompresses transparently
+    s.headers["Accept-Encoding"] = "gzip"
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=16,
+        max_retries=Retry(total=3, backoff_factor=0.3,
+                          status_forcelist=[429, 500, 502, 503, 504]),
+    )
+    s.mount("https://", adapter)
+    return s
 
+@st.cache_resource
+def _disk():
+    # Second cache tier that survives Streamlit restarts; None when
+    # diskcache is not installed.
+    if diskcache is None:
+        return None
+    return diskcache.Cache("/tmp/soilgrids", size_limit=200 * 1024 * 1024)
+
+@st.cache_data(ttl=86400, show_spinner=False, max_entries=4096)
 def fetch_property_for_point(lat: float, lon: float, prop: str) -> Tuple[Optional[float], Optional[str]]:
+    # Snap to a 0.01° tile so nearby queries share one cache key
+    lat, lon = round(lat, 2), round(lon, 2)
+    # Two-tier cache: st.cache_data covers the rerun-hot path above,
+    # diskcache covers the restart-cold path here
+    cache = _disk()
+    key = (lat, lon, prop)
+    if cache is not None and key in cache:
+        return cache[key]
+    result = _fetch_property_uncached(lat, lon, prop)
+    if cache is not None and result[0] is not None:
+        cache.set(key, result, expire=30 * 86400)
+    return result
+
+def _fetch_property_uncached(lat: float, lon: float, prop: str) -> Tuple[Optional[float], Optional[str]]:
     # Try primary point
     val, unit = _fetch_value(lat, lon, prop)
     if val is not None:
         return val, unit
-    # Option A: try nearby points with small delta
-    delta = [0.01, -0.01, 0.02, -0.02]
-    for dlat in delta:
-        for dlon in delta:
-            val, unit = _fetch_value(lat + dlat, lon + dlon, prop)
+    # Option A: bounded retry on 4 neighbouring tiles, concurrently
+    # (the old 4x4 delta grid fired up to 16 serial requests per property)
+    neighbours = [(lat + 0.02, lon), (lat - 0.02, lon),
+                  (lat, lon + 0.02), (lat, lon - 0.02)]
+    with ThreadPoolExecutor(max_workers=len(neighbours)) as ex:
+        for val, unit in ex.map(lambda c: _fetch_value(c[0], c[1], prop), neighbours):
             if val is not None:
                 return val, unit
-    # Option B: fallback to default
-    return DEFAULT_VALUES[prop], ""
+    # No data anywhere nearby; the caller applies defaults in one pass
+    return None, None
 
 def _fetch_value(lat: float, lon: float, prop: str) -> Tuple[Optional[float], Optional[str]]:
     params = {"lat": lat, "lon": lon, "property": prop}
     try:
-        r = requests.get(SOILGRIDS_API, params=params, timeout=25)
+        r = _session().get(SOILGRIDS_API, params=params, timeout=25)
     except requests.RequestException:
         return None, None
 
@@ -98,95 +215,289 @@ def _fetch_value(lat: float, lon: float, prop: str) -> Tuple[Optional[float], Op
         return None, None
 
     try:
-        data = r.json()
+        data = _loads(r.content)
     except Exception:
         return None, None
 
-    layers = data.get("properties", {}).get("layers")
-    layer_obj = None
-    if isinstance(layers, dict):
-        layer_obj = layers.get(prop)
-    elif isinstance(layers, list):
-        for item in layers:
-            if isinstance(item, dict) and item.get("name") == prop:
-                layer_obj = item
-                break
+    return _extract_prop_from_payload(data, prop)
+
+def _layers_by_name(data: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    # Pivot the layers list into a name-keyed dict once, so each
+    # property lookup is O(1) instead of a list scan.
+    layers = data.get("properties", {}).get("layers") or []
+    if isinstance(layers, list):
+        layers = {l["name"]: l for l in layers if isinstance(l, dict) and "name" in l}
+    return layers if isinstance(layers, dict) else {}
 
+def _extract_prop_from_payload(data: Dict[str, Any], prop: str) -> Tuple[Optional[float], Optional[str]]:
+    layer_obj = _layers_by_name(data).get(prop)
     if not layer_obj:
         return None, None
+    return _parse_layer(layer_obj)
 
+async def _fetch_props_async(lat: float, lon: float, props: List[str]) -> Dict[str, Tuple[Optional[float], Optional[str]]]:
+    # One event loop, one HTTP/2 connection multiplexing all queries.
+    # The client is scoped to this coroutine rather than st.cache_resource
+    # because it must live and die with the asyncio.run loop driving it.
+    async with httpx.AsyncClient(http2=True, timeout=25,
+                                 headers={"Accept": "application/json"}) as client:
+        async def one(prop: str) -> Tuple[str, Tuple[Optional[float], Optional[str]]]:
+            try:
+                r = await client.get(SOILGRIDS_API, params={"lat": lat, "lon": lon, "property": prop})
+            except httpx.HTTPError:
+                return prop, (None, None)
+            if r.status_code != 200:
+                return prop, (None, None)
+            try:
+                data = _loads(r.content)
+            except Exception:
+                return prop, (None, None)
+            return prop, _extract_prop_from_payload(data, prop)
+
+        return dict(await asyncio.gather(*[one(p) for p in props]))
+
+def _order_depth_entries(depths: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # One pass to resolve each entry's (top, bottom), then preferred
+    # intervals first and shallowest after — no per-comparison reparsing.
+    indexed: List[Tuple[Tuple[float, float], Dict[str, Any]]] = []
+    unparsed: List[Dict[str, Any]] = []
+    for d in depths:
+        tb = _get_top_bottom_from_range(d) or _try_parse_depth_from_label(
+            d.get("label") or d.get("depth_label") or "")
+        if tb is None:
+            unparsed.append(d)
+        else:
+            indexed.append((tb, d))
+    unranked = len(PREFERRED_DEPTHS)
+    indexed.sort(key=lambda x: (_PREFERRED_DEPTH_RANK.get(x[0], unranked), x[0][0]))
+    return [d for _, d in indexed] + unparsed
+
+def _parse_layer(layer_obj: Dict[str, Any]) -> Tuple[Optional[float], Optional[str]]:
     depths = layer_obj.get("depths") or []
     unit = _extract_unit(layer_obj)
     d_factor = layer_obj.get("unit_measure", {}).get("d_factor", 1)
+    # One division here instead of one per depth entry
+    inv = 1.0 / d_factor if d_factor else 1.0
 
-    for d in depths:
+    for d in _order_depth_entries(depths):
         vals = d.get("values") or {}
-        numeric = _extract_numeric_from_values(vals, d_factor=d_factor)
+        numeric = _extract_numeric_from_values(vals, inv)
         if numeric is not None:
             return numeric, unit
     return None, unit
 
-def fetch_soil_data_all(lat: float, lon: float) -> Dict[str, Dict[str, Any]]:
-    out: Dict[str, Dict[str, Any]] = {}
+# Per-request params only add lat/lon on top of this template. Asking
+# only for the statistics we read (mean, plus median as its fallback)
+# drops the quantile/uncertainty sub-trees from the payload server-side.
+_MULTI_PARAMS = {"property": PROPERTIES, "value": ["mean", "Q0.5"]}
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def _parse_multi_content(content: bytes) -> Dict[str, Dict[str, Any]]:
+    # Keyed on the response bytes, so a revalidated or HTTP-cached body
+    # is not re-parsed on every rerun.
+    try:
+        data = _loads(content)
+    except Exception:
+        return {}
+
+    parsed = (
+        (name, layer_obj, _parse_layer(layer_obj))
+        for name, layer_obj in _layers_by_name(data).items()
+        if name in PROPERTIES and isinstance(layer_obj, dict)
+    )
+    return {
+        name: {"value": val, "unit": unit, "raw": layer_obj}
+        for name, layer_obj, (val, unit) in parsed
+    }
+
+def fetch_soil_data_multi(lat: float, lon: float) -> Dict[str, Dict[str, Any]]:
+    # One round trip for all properties; requests serializes the list
+    # into repeated property= params, which SoilGrids accepts.
+    params = {**_MULTI_PARAMS, "lat": lat, "lon": lon}
+    try:
+        r = _session().get(SOILGRIDS_API, params=params, timeout=25)
+    except requests.RequestException:
+        return {}
+
+    if r.status_code != 200:
+        return {}
+
+    return _parse_multi_content(r.content)
+
+def fetch_soil_data_all(lat: float, lon: float, _on_update=None) -> Dict[str, Dict[str, Any]]:
+    # _on_update is called with the partial result whenever new values
+    # arrive, so the UI can render rows before the slowest fetch
+    # finishes. That rendering draws on containers created by the
+    # caller, which is why this orchestrator must NOT sit behind
+    # st.cache_data: cached functions replay their recorded element
+    # calls on a hit, and a closure-captured st.empty can't be resolved
+    # then (CacheReplayClosureError on the second lookup of the same
+    # point). Memoization lives in the layers below instead —
+    # _parse_multi_content, fetch_property_for_point, and the
+    # requests-cache/diskcache tiers — so a warm repeat is still served
+    # without re-fetching.
+    # Snap to the grid so nearby queries share one cache key
+    lat, lon = _snap(lat), _snap(lon)
+    # Primary path: one batched request covering every property
+    out = fetch_soil_data_multi(lat, lon)
+    if out and _on_update:
+        _on_update(out)
+    missing = [p for p in PROPERTIES if out.get(p, {}).get("value") is None]
+    if missing and httpx is not None:
+        # Async pass over one multiplexed connection for the stragglers
+        for p, (val, unit) in asyncio.run(_fetch_props_async(lat, lon, missing)).items():
+            if val is not None:
+                out[p] = {**out.get(p, {}), "value": val, "unit": unit}
+        missing = [p for p in PROPERTIES if out.get(p, {}).get("value") is None]
+        if _on_update:
+            _on_update(out)
+    if missing:
+        # Fallback: fetch the missing properties individually, concurrently
+        with ThreadPoolExecutor(max_workers=len(missing)) as ex:
+            futs = {ex.submit(fetch_property_for_point, lat, lon, p): p for p in missing}
+            for fut in as_completed(futs):
+                p = futs[fut]
+                val, unit = fut.result()
+                out[p] = {**out.get(p, {}), "value": val, "unit": unit}
+                if _on_update:
+                    _on_update(out)
+    # Single post-pass for defaults instead of burying them in the
+    # per-property retry path
     for p in PROPERTIES:
-        val, unit = fetch_property_for_point(lat, lon, p)
-        out[p] = {"value": val, "unit": unit}
+        if out.get(p, {}).get("value") is None:
+            out[p] = {**out.get(p, {}), "value": DEFAULT_VALUES[p], "unit": ""}
     return out
 
+def fetch_soil_data_points(points: List[Tuple[float, float]]) -> pd.DataFrame:
+    # Batch mode: one multi-property request per point, fanned out over
+    # the shared connection pool, straight into a DataFrame.
+    def one(pt: Tuple[float, float]) -> Dict[str, Any]:
+        out = fetch_soil_data_multi(_snap(pt[0]), _snap(pt[1]))
+        row: Dict[str, Any] = {"lat": pt[0], "lon": pt[1]}
+        for p in PROPERTIES:
+            v = out.get(p, {}).get("value")
+            row[p] = DEFAULT_VALUES[p] if v is None else v
+        return row
+
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        return pd.DataFrame(list(ex.map(one, points)))
+
+@st.cache_resource
+def _geolocator() -> Nominatim:
+    return Nominatim(user_agent="soil_app")
+
+@st.cache_data(ttl=604800, show_spinner=False)
 def get_location_name(lat: float, lon: float) -> str:
+    # Nominatim asks for ~1 req/s, so cache geocodes for a week
     try:
-        geolocator = Nominatim(user_agent="soil_app")
-        location = geolocator.reverse((lat, lon), language="en")
+        location = _geolocator().reverse((round(lat, 4), round(lon, 4)), language="en")
         if location:
             return location.address
         return "Unknown Location"
-    except:
+    except Exception:
         return "Unknown Location"
 
 # -----------------------------
 # Streamlit UI
 # -----------------------------
-st.set_page_config(page_title="SoilGrids Explorer", layout="centered", initial_sidebar_state="collapsed")
-st.title("SoilGrids Explorer — lat/lon → soil properties")
-st.markdown(
+# Static UI text lives in module constants so the rerun loop only pays
+# for widget calls, not for rebuilding literals. The heavyweight objects
+# (Session, Nominatim client) are already behind st.cache_resource;
+# st.set_page_config itself must run on every rerun per Streamlit's API.
+_PAGE_CONFIG = dict(page_title="SoilGrids Explorer", layout="centered",
+                    initial_sidebar_state="collapsed")
+_TITLE = "SoilGrids Explorer — lat/lon → soil properties"
+_INTRO_MD = (
     "Enter latitude & longitude and the app will query ISRIC SoilGrids for common soil properties "
     "(SOC, pH, sand/silt/clay, bulk density, OCS)."
 )
+_PROPERTIES_LINE = ", ".join(PROPERTIES)
+_DEPTHS_CAPTION = "We attempt all available depths and return the first non-NULL value, scaled if needed. If data is missing, nearby points or defaults are used."
+_GRID_CAPTION = "Coordinates are snapped to a ~200 m grid, matching SoilGrids' native resolution."
+
+st.set_page_config(**_PAGE_CONFIG)
+st.title(_TITLE)
+st.markdown(_INTRO_MD)
 
 with st.expander("Which properties are requested?"):
-    st.write(", ".join(PROPERTIES))
-    st.caption("We attempt all available depths and return the first non-NULL value, scaled if needed. If data is missing, nearby points or defaults are used.")
+    st.write(_PROPERTIES_LINE)
+    st.caption(_DEPTHS_CAPTION)
+    st.caption(_GRID_CAPTION)
+
+# Default = Punjab
+_DEFAULT_LAT = 31.1471
+_DEFAULT_LON = 75.3412
 
 col1, col2 = st.columns(2)
 with col1:
-    lat = st.number_input("Latitude", value=31.1471, format="%.6f")  # Default = Punjab
+    lat = st.number_input("Latitude", value=_DEFAULT_LAT, format="%.6f")
 with col2:
-    lon = st.number_input("Longitude", value=75.3412, format="%.6f")
+    lon = st.number_input("Longitude", value=_DEFAULT_LON, format="%.6f")
 
-if st.button("Get Soil Data"):
-    with st.spinner("Querying SoilGrids..."):
-        out = fetch_soil_data_all(lat, lon)
-        location_name = get_location_name(lat, lon)
-
-    rows = []
+def _results_table(out: Dict[str, Dict[str, Any]]) -> pd.DataFrame:
+    # Column-wise construction: no per-row dicts and no set_index copy
+    vals, units = [], []
     for prop in PROPERTIES:
         rec = out.get(prop, {})
         val = rec.get("value")
-        unit = rec.get("unit") or ""
-        display_val = f"{val:.4g}" if val is not None else "No data"
-        rows.append({"Property": prop.upper(), "Value": display_val, "Unit": unit})
+        units.append(rec.get("unit") or "")
+        if val is not None:
+            vals.append(f"{val:.4g}")
+        elif prop not in out:
+            vals.append("…")  # still fetching
+        else:
+            vals.append("No data")
+    df = pd.DataFrame({"Value": vals, "Unit": units}, index=PROPERTIES_UPPER)
+    df.index.name = "Property"
+    return df
 
-    df = pd.DataFrame(rows)
-    st.subheader(f"Soil Data for {location_name}")
-    st.table(df.set_index("Property"))
+@st.fragment
+def _results_panel(lat: float, lon: float) -> None:
+    # Fragment: a click (and the fetch behind it) reruns only this
+    # block, so the header, inputs, and batch expander stay responsive.
+    if st.button("Get Soil Data"):
+        subheader_slot = st.empty()
+        table_slot = st.empty()
+        with st.spinner("Querying SoilGrids..."):
+            # Rows appear as soon as each fetch resolves instead of after
+            # the slowest one
+            out = fetch_soil_data_all(lat, lon, _on_update=lambda partial: table_slot.table(_results_table(partial)))
+            location_name = get_location_name(lat, lon)
 
-    try:
-        st.subheader("Location preview")
-        st.map(pd.DataFrame({"lat": [lat], "lon": [lon]}))
-    except Exception:
-        pass
+        subheader_slot.subheader(f"Soil Data for {location_name}")
+        table_slot.table(_results_table(out))
+
+        with st.expander("Raw property JSON"):
+            # st.code streams plain text; st.json builds a widget tree per
+            # element, which is far slower for kilobyte payloads
+            for prop in PROPERTIES:
+                st.markdown(f"**{prop.upper()}**")
+                raw = out.get(prop, {}).get("raw")
+                st.code(_dumps_pretty(raw) if raw else "null", language="json")
+
+        try:
+            st.subheader("Location preview")
+            st.map(pd.DataFrame({"lat": [lat], "lon": [lon]}))
+        except Exception:
+            pass
+
+        st.caption("⚠️ Some values are defaults or estimated because SoilGrids data is missing in this region.")
+
+_results_panel(lat, lon)
 
-    st.caption("⚠️ Some values are defaults or estimated because SoilGrids data is missing in this region.")
+with st.expander("Batch lookup from CSV"):
+    uploaded = st.file_uploader("CSV with 'lat' and 'lon' columns", type="csv")
+    if uploaded is not None:
+        pts_df = pd.read_csv(uploaded)
+        if {"lat", "lon"}.issubset(pts_df.columns):
+            points = list(zip(pts_df["lat"], pts_df["lon"]))
+            with st.spinner(f"Querying SoilGrids for {len(points)} points..."):
+                batch_df = fetch_soil_data_points(points)
+            st.dataframe(batch_df)
+            st.download_button("Download results CSV", batch_df.to_csv(index=False),
+                               "soil_data.csv", "text/csv")
+        else:
+            st.error("CSV must have 'lat' and 'lon' columns.")
 
 # Permanent footer
 st.markdown("---")